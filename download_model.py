@@ -1,8 +1,67 @@
+import argparse
+import importlib.util
+import json
+import os
+from pathlib import Path
+
+# Route downloads through the Rust hf_transfer backend (chunked, multi-connection)
+# when it is installed. Must be set before huggingface_hub is imported; enabling
+# it without the package installed makes huggingface_hub raise.
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 from huggingface_hub import snapshot_download
 
 model_id = "open-sci/open-sci-ref-v0.01-1.7b-nemotron-hq-1T-16384"
 local_dir = "./open-sci-ref-v0.01-1.7b-nemotron-hq-1T-16384"
 
-print(f"Downloading {model_id} ...")
-snapshot_download(repo_id=model_id, local_dir=local_dir)
-print(f"Done. Model saved to {local_dir}")
+
+def _is_complete(path: Path) -> bool:
+    """
+    True if path already holds a complete download: config, remote code,
+    tokenizer and every non-empty weight shard, with no interrupted files left.
+    """
+    if not (path / "config.json").is_file():
+        return False
+    # snapshot_download keeps partial files here until they finish.
+    if any((path / ".cache" / "huggingface" / "download").glob("**/*.incomplete")):
+        return False
+    # trust_remote_code needs the model's own modeling/configuration modules.
+    for pattern in ("modeling_*.py", "configuration_*.py", "tokenizer_config.json"):
+        if not any(path.glob(pattern)):
+            return False
+    if not any((path / f).is_file() for f in ("tokenizer.json", "tokenizer.model", "vocab.json")):
+        return False
+    index = path / "model.safetensors.index.json"
+    if index.is_file():
+        shards = set(json.loads(index.read_text())["weight_map"].values())
+    else:
+        shards = {p.name for p in path.glob("*.safetensors")}
+    return bool(shards) and all(
+        (path / s).is_file() and (path / s).stat().st_size > 0 for s in shards
+    )
+
+
+parser = argparse.ArgumentParser(description=f"Download {model_id}.")
+parser.add_argument(
+    "--force", action="store_true",
+    help="Always run snapshot_download, e.g. to repair a damaged local copy.",
+)
+args = parser.parse_args()
+
+# A populated directory needs no network round trips at all; snapshot_download
+# would still issue a HEAD request per file to compare ETags. Rerunning after an
+# interrupted download resumes it, since _is_complete() is then False.
+if not args.force and _is_complete(Path(local_dir)):
+    print(f"{model_id} already present in {local_dir}, skipping download "
+          "(use --force to re-check against the Hub).")
+else:
+    print(f"Downloading {model_id} ...")
+    # Fetch the weight shards concurrently rather than relying on the default pool size.
+    snapshot_download(
+        repo_id=model_id,
+        local_dir=local_dir,
+        max_workers=min(16, (os.cpu_count() or 1) * 2),
+        etag_timeout=30,
+    )
+    print(f"Done. Model saved to {local_dir}")
@@ -2,7 +2,10 @@
 hotfix_opensci.py
 
 Copies a model directory to <src_dir>_fixed and patches every modeling_*.py
-for compatibility with transformers 5.0+:
+for compatibility with transformers 5.0+. All other files are never modified
+and are hardlinked where possible, so they share their data with <src_dir>;
+editing one of them in place under <src_dir>_fixed also changes the original.
+The fixes are:
 
   1. LossKwargs → TransformersKwargs          (LossKwargs removed in 5.0)
   2. ROPE 'default' fallback inlined           ('default' key removed from
@@ -10,11 +13,12 @@ for compatibility with transformers 5.0+:
   3. _tied_weights_keys list → dict           (5.0 requires a {key: source} dict;
                                                list format leaves lm_head
                                                uninitialised at load time)
-  4. SDPA dispatch inlined                    (transformers 5.x passes enable_gqa=True
+  4. SDPA dispatch made version-stable        (transformers 5.x passes enable_gqa=True
                                                to scaled_dot_product_attention even for
                                                MHA models, selecting a different numerical
-                                               path than 4.x; inlining the 4.x wrapper
-                                               restores identical attention computation)
+                                               path than 4.x; a module-level copy of the
+                                               4.x wrapper restores identical attention
+                                               computation)
   5. inv_freq re-init guard added             (transformers 5.x uses meta-device loading:
                                                non-persistent buffers are zeroed when weights
                                                are materialised; the guard re-computes
@@ -29,12 +33,18 @@ Usage:
 """
 
 import argparse
+import os
 import re
 import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+# All fixes are pure-ASCII substitutions, so patch_file works on the raw UTF-8
+# bytes and never decodes the source; the snippets and patterns are bytes too.
+
 # Inline fallback inserted when ROPE_INIT_FUNCTIONS["default"] is missing.
-_ROPE_FALLBACK = '''\
+_ROPE_FALLBACK = b'''\
 if self.rope_type in ROPE_INIT_FUNCTIONS:
             self.rope_init_fn = ROPE_INIT_FUNCTIONS[self.rope_type]
         else:
@@ -56,7 +66,7 @@ if self.rope_type in ROPE_INIT_FUNCTIONS:
 # transformers 5.x adds enable_gqa=True to scaled_dot_product_attention even for
 # plain MHA (groups=1), which routes to a different PyTorch kernel and shifts logits
 # by ~0.6 relative to 4.x. Inlining the 4.x wrapper avoids this.
-_SDPA_OLD = '''\
+_SDPA_OLD = b'''\
         attention_interface: Callable = eager_attention_forward
         if self.config._attn_implementation != "eager":
             if self.config._attn_implementation == "sdpa" and kwargs.get("output_attentions", False):
@@ -68,27 +78,39 @@ _SDPA_OLD = '''\
                 attention_interface = ALL_ATTENTION_FUNCTIONS[self.config._attn_implementation]\
 '''
 
-_SDPA_STABLE = '''\
+_SDPA_STABLE = b'''\
         attention_interface: Callable = eager_attention_forward
         if self.config._attn_implementation == "sdpa" and not kwargs.get("output_attentions", False):
-            # Inline the 4.x-compatible SDPA wrapper: never passes enable_gqa so the
-            # same PyTorch kernel is selected regardless of transformers version.
-            def attention_interface(module, query, key, value, attention_mask, scaling, dropout=0.0, is_causal=None, **kw):
-                if hasattr(module, "num_key_value_groups"):
-                    key = repeat_kv(key, module.num_key_value_groups)
-                    value = repeat_kv(value, module.num_key_value_groups)
-                query, key, value = query.contiguous(), key.contiguous(), value.contiguous()
-                if is_causal is None:
-                    is_causal = attention_mask is None and query.shape[2] > 1
-                out = torch.nn.functional.scaled_dot_product_attention(
-                    query, key, value, attn_mask=attention_mask,
-                    dropout_p=dropout, scale=scaling, is_causal=is_causal,
-                )
-                return out.transpose(1, 2).contiguous(), None
+            # 4.x-compatible SDPA wrapper: never passes enable_gqa so the same
+            # PyTorch kernel is selected regardless of transformers version.
+            attention_interface = _sdpa_mha_forward
         elif self.config._attn_implementation not in ("eager", "sdpa"):
             attention_interface = ALL_ATTENTION_FUNCTIONS[self.config._attn_implementation]\
 '''
 
+# Module-level wrapper referenced by _SDPA_STABLE, inserted just before
+# eager_attention_forward. Defining it once at module scope avoids building a
+# closure on every attention forward (once per layer per decoded token).
+# repeat_kv is a no-op for n_rep == 1, so skipping it for MHA is exact.
+_SDPA_FORWARD_ANCHOR = b"\ndef eager_attention_forward("
+
+_SDPA_FORWARD_DEF = b'''\
+def _sdpa_mha_forward(module, query, key, value, attention_mask, scaling, dropout=0.0, is_causal=None, **kwargs):
+    # Inlined 4.x-compatible SDPA wrapper (added by hotfix_opensci.py).
+    n_rep = getattr(module, "num_key_value_groups", 1)
+    if n_rep != 1:
+        key = repeat_kv(key, n_rep)
+        value = repeat_kv(value, n_rep)
+    query, key, value = query.contiguous(), key.contiguous(), value.contiguous()
+    if is_causal is None:
+        is_causal = attention_mask is None and query.shape[2] > 1
+    out = torch.nn.functional.scaled_dot_product_attention(
+        query, key, value, attn_mask=attention_mask,
+        dropout_p=dropout, scale=scaling, is_causal=is_causal,
+    )
+    return out.transpose(1, 2).contiguous(), None
+'''
+
 
 # Guard inserted into OpensciRotaryEmbedding.forward to re-initialise inv_freq
 # if it was zeroed by transformers 5.x meta-device loading.
@@ -96,12 +118,12 @@ _SDPA_STABLE = '''\
 # the model from the meta device, those buffers become zero tensors.  Detecting
 # this on the first forward pass and recomputing from rope_init_fn restores the
 # correct ROPE frequencies without any change to the __init__ signature.
-_ROPE_REINIT_OLD = '''\
+_ROPE_REINIT_OLD = b'''\
         # Core RoPE block
         inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)\
 '''
 
-_ROPE_REINIT_FIXED = '''\
+_ROPE_REINIT_FIXED = b'''\
         # Re-initialize inv_freq if it was zeroed during meta-device loading (transformers 5.x).
         # Non-persistent buffers are not stored in the checkpoint; 5.x materialises them as
         # zeros when moving the model off the meta device.
@@ -114,45 +136,146 @@ _ROPE_REINIT_FIXED = '''\
 '''
 
 
-def patch_file(path: Path) -> bool:
-    src = path.read_text(encoding="utf-8")
-    original = src
+# Textual fixes 1-3 as a single alternation so the source is scanned only once.
+# Exactly one group matches per hit; _fused_sub dispatches on which one.
+_RE_FUSED = re.compile(
+    rb"(LossKwargs)"
+    rb"|(self\.rope_init_fn\s*=\s*ROPE_INIT_FUNCTIONS\[self\.rope_type\])"
+    rb"|_tied_weights_keys\s*=\s*(\[[^\]]*\])"
+)
+
+# Substrings at least one of which must be present for any fix to apply;
+# files containing none of them are skipped before any regex work.
+_ANCHORS = (b"LossKwargs", b"ROPE_INIT_FUNCTIONS", b"_tied_weights_keys", b"_attn_implementation", b"inv_freq")
 
-    # 1. LossKwargs → TransformersKwargs
-    src = src.replace("LossKwargs", "TransformersKwargs")
 
+def list_to_dict(m: re.Match) -> bytes:
+    # Keys are the odd fields between double quotes: [b'[', b'lm_head.weight', b']']
+    # Empty strings are dropped, as the original '"([^"]+)"' regex did.
+    keys = [k for k in m.group(3).split(b'"')[1::2] if k]
+    pairs = b", ".join(b'"%s": "model.embed_tokens.weight"' % k for k in keys)
+    return b"_tied_weights_keys = {%s}" % pairs
+
+
+def _fused_sub(m: re.Match) -> bytes:
+    # 1. LossKwargs → TransformersKwargs
+    if m.group(1):
+        return b"TransformersKwargs"
     # 2. ROPE 'default' fallback
     #    Replace: self.rope_init_fn = ROPE_INIT_FUNCTIONS[self.rope_type]
     #    With a try/else that inlines the default computation.
-    src = re.sub(
-        r"self\.rope_init_fn\s*=\s*ROPE_INIT_FUNCTIONS\[self\.rope_type\]",
-        _ROPE_FALLBACK,
-        src,
-    )
-
+    if m.group(2):
+        return _ROPE_FALLBACK
     # 3. _tied_weights_keys: list → dict
     #    e.g. ["lm_head.weight"]  →  {"lm_head.weight": "model.embed_tokens.weight"}
-    def list_to_dict(m: re.Match) -> str:
-        keys = re.findall(r'"([^"]+)"', m.group(1))
-        pairs = ", ".join(f'"{k}": "model.embed_tokens.weight"' for k in keys)
-        return f"_tied_weights_keys = {{{pairs}}}"
-
-    src = re.sub(
-        r"_tied_weights_keys\s*=\s*(\[[^\]]*\])",
-        list_to_dict,
-        src,
-    )
+    return list_to_dict(m)
+
+
+def patch_file(path: Path) -> bool:
+    src = path.read_bytes()
+    if not any(a in src for a in _ANCHORS):
+        return False
+    # Every step rebinds src and no other reference to the previous buffer is
+    # kept, so at most the input and output of the current step are alive at
+    # once, which matters when many files are patched in parallel workers.
+    changed = False
 
-    # 4. SDPA dispatch: replace with inline wrapper that omits enable_gqa
-    src = src.replace(_SDPA_OLD, _SDPA_STABLE)
+    # 1-3. LossKwargs, ROPE fallback and _tied_weights_keys in one pass
+    src, n = _RE_FUSED.subn(_fused_sub, src)
+    changed |= n > 0
+
+    # 4. SDPA dispatch: route to a module-level wrapper that omits enable_gqa
+    #    Each block is located first, so files without it (most of them) skip
+    #    the replace and its allocation entirely.
+    if _SDPA_OLD in src:
+        src = src.replace(_SDPA_OLD, _SDPA_STABLE)
+        if _SDPA_FORWARD_ANCHOR in src:
+            src = src.replace(
+                _SDPA_FORWARD_ANCHOR, b"\n" + _SDPA_FORWARD_DEF + b"\n" + _SDPA_FORWARD_ANCHOR, 1
+            )
+        else:
+            src += b"\n\n" + _SDPA_FORWARD_DEF
+        changed = True
 
     # 5. inv_freq re-init guard: re-compute if zeroed by meta-device loading
-    src = src.replace(_ROPE_REINIT_OLD, _ROPE_REINIT_FIXED)
+    if _ROPE_REINIT_OLD in src:
+        src = src.replace(_ROPE_REINIT_OLD, _ROPE_REINIT_FIXED)
+        changed = True
+
+    if changed:
+        path.write_bytes(src)
+    return changed
 
-    if src == original:
+
+def _clonefile(src: str, dst: str) -> bool:
+    """Clone src to dst with macOS clonefile(2); False if unavailable or unsupported."""
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if not hasattr(libc, "clonefile"):
         return False
-    path.write_text(src, encoding="utf-8")
-    return True
+    return libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+
+
+def _fast_copy(src: str, dst: str) -> str:
+    """
+    copytree copy_function that keeps the data transfer inside the kernel.
+
+    Weight shards are multi-GB; copy_file_range(2) lets the filesystem reflink
+    them on CoW filesystems (btrfs/xfs) and avoids user-space buffering on the
+    rest. On macOS, clonefile(2) gives an O(1) copy on APFS. Anything that is
+    not supported falls back to shutil.copyfile.
+    """
+    if sys.platform == "darwin" and _clonefile(src, dst):
+        return dst
+    copied = size = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+        except OSError:
+            # Unsupported here (e.g. EXDEV, ENOSYS): fall back only if nothing
+            # was written yet, as shutil does.
+            if copied:
+                raise
+    # Some kernels/filesystems return 0 straight away for non-empty files;
+    # treat that as "not supported" rather than leaving dst truncated.
+    if copied == 0:
+        shutil.copyfile(src, dst)
+    elif copied < size:
+        raise OSError(f"copy_file_range stopped after {copied} of {size} bytes: {src}")
+    shutil.copystat(src, dst)
+    return dst
+
+
+def _is_model_file(name: str) -> bool:
+    """True for the modeling_*.py files that patch_file rewrites."""
+    return name.startswith("modeling_") and name.endswith(".py")
+
+
+def _link_or_copy(src: str, dst: str) -> str:
+    """
+    copytree copy_function that hardlinks files the hotfix never modifies.
+
+    Only modeling_*.py files are rewritten, so they get a real copy; weights,
+    tokenizer and config files are hardlinked, falling back to a copy when
+    linking is not possible (e.g. across devices).
+
+    A hardlinked file shares its inode with the original: editing it in place
+    in <src_dir>_fixed also changes <src_dir>.
+    """
+    if _is_model_file(os.path.basename(src)):
+        return _fast_copy(src, dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        return _fast_copy(src, dst)
+    return dst
 
 
 def hotfix_opensci(src_dir: str | Path) -> Path:
@@ -164,11 +287,28 @@ def hotfix_opensci(src_dir: str | Path) -> Path:
     print(f"Copying '{src_dir}' -> '{fixed_dir}' ...")
     if fixed_dir.exists():
         shutil.rmtree(fixed_dir)
-    shutil.copytree(src_dir, fixed_dir)
+    shutil.copytree(src_dir, fixed_dir, copy_function=_link_or_copy)
+
+    # scandir reports the entry type from the directory listing itself, so
+    # filtering out the (many) weight shards costs no extra stat calls.
+    with os.scandir(fixed_dir) as entries:
+        model_files = sorted(
+            Path(e.path) for e in entries
+            if _is_model_file(e.name) and e.is_file(follow_symlinks=False)
+        )
+    # A single file (the usual case) is patched inline: starting a worker
+    # process would cost far more than the patch itself.
+    if len(model_files) <= 1:
+        results = [patch_file(f) for f in model_files]
+    else:
+        # Each file is patched independently, so fan the work out across processes.
+        workers = min(len(model_files), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            results = list(ex.map(patch_file, model_files))
 
     patched = 0
-    for model_file in sorted(fixed_dir.glob("modeling_*.py")):
-        if patch_file(model_file):
+    for model_file, was_patched in zip(model_files, results):
+        if was_patched:
             print(f"  Patched: {model_file.name}")
             patched += 1
         else:
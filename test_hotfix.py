@@ -1,14 +1,20 @@
 """
 Tests that inference.py produces a sensible completion across transformers versions.
 
-Each test spawns a subprocess:
+Each inference test spawns a subprocess:
     uv run [--with transformers==X] python inference.py --model_path ...
 
 4.x tests use the original model directory (TransformersKwargs back-filled at
 runtime). 5.x tests use the hotfix_opensci.py output (_fixed directory) which
 has all patches baked into the model files — no runtime monkey-patching needed.
+
+The test_patch_file_* / test_hotfix_* tests at the bottom run hotfix_opensci.py
+in-process on small synthetic model directories; they need neither uv, a GPU
+nor the downloaded model.
 """
 
+import ast
+import atexit
 import json
 import shutil
 import subprocess
@@ -16,6 +22,8 @@ from pathlib import Path
 
 import pytest
 
+from hotfix_opensci import hotfix_opensci, patch_file
+
 MODEL_ORIG   = str(Path(__file__).parent / "open-sci-ref-v0.01-1.7b-nemotron-hq-1T-16384")
 MODEL_FIXED  = str(Path(__file__).parent / "open-sci-ref-v0.01-1.7b-nemotron-hq-1T-16384_fixed")
 INFERENCE    = str(Path(__file__).parent / "inference.py")
@@ -25,21 +33,28 @@ EXPECTED_WORD = "Paris"
 UV = shutil.which("uv") or "uv"
 
 
+# pytest's default fd-level capture redirects even sys.__stdout__, so we
+# write directly to /dev/tty (the controlling terminal) to always be visible.
+# Opened once rather than on every write, and closed at interpreter exit.
+try:
+    _TTY = open("/dev/tty", "w")
+    atexit.register(_TTY.close)
+except OSError:
+    _TTY = None  # not a real terminal (CI / redirected output)
+
+
+def _echo(text: str):
+    if _TTY and text:
+        _TTY.write(text)
+        _TTY.flush()
+
+
 def _run(transformers_version: str, model_path: str) -> subprocess.CompletedProcess:
     cmd = [UV, "run", "--with", f"transformers=={transformers_version}",
            "python", INFERENCE, "--model_path", model_path]
     result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-    # pytest's default fd-level capture redirects even sys.__stdout__, so we
-    # write directly to /dev/tty (the controlling terminal) to always be visible.
-    try:
-        with open("/dev/tty", "w") as tty:
-            if result.stdout:
-                tty.write(result.stdout)
-            if result.stderr:
-                tty.write(result.stderr)
-            tty.flush()
-    except OSError:
-        pass  # not a real terminal (CI / redirected output)
+    _echo(result.stdout)
+    _echo(result.stderr)
     return result
 
 
@@ -84,13 +99,7 @@ def _run_logits(version: str, model_path: str) -> list[dict]:
     cmd = [UV, "run", "--with", f"transformers=={version}",
            "python", LOGIT_CHECK, "--model_path", model_path]
     result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-    try:
-        with open("/dev/tty", "w") as tty:
-            if result.stderr:
-                tty.write(result.stderr)
-            tty.flush()
-    except OSError:
-        pass
+    _echo(result.stderr)
     assert result.returncode == 0, (
         f"[{version}] logit_check exited {result.returncode}\n"
         f"STDERR:\n{result.stderr}"
@@ -115,15 +124,10 @@ def test_logits_top_token_consistent():
     for version, model_path in cases:
         tokens = _run_logits(version, model_path)
         top_tokens[version] = tokens[0]
-        try:
-            with open("/dev/tty", "w") as tty:
-                tty.write(
-                    f"[{version}] top token: {tokens[0]['token']!r:20s} "
-                    f"logit={tokens[0]['logit']:.4f}\n"
-                )
-                tty.flush()
-        except OSError:
-            pass
+        _echo(
+            f"[{version}] top token: {tokens[0]['token']!r:20s} "
+            f"logit={tokens[0]['logit']:.4f}\n"
+        )
 
     top_ids = {v: t["token_id"] for v, t in top_tokens.items()}
     assert len(set(top_ids.values())) == 1, (
@@ -133,3 +137,120 @@ def test_logits_top_token_consistent():
             for v, t in top_tokens.items()
         )
     )
+
+
+# ── patch_file: offline, on a synthetic modeling file ────────────────────────
+
+# Minimal stand-in for modeling_opensci.py containing all five patch anchors.
+_SYNTHETIC_MODELING = '''\
+from typing import Callable
+
+import torch
+from transformers.utils import LossKwargs
+
+
+def repeat_kv(hidden_states, n_rep):
+    return hidden_states
+
+
+def eager_attention_forward(module, query, key, value, attention_mask, scaling, dropout=0.0, **kwargs):
+    return query, None
+
+
+class OpensciRotaryEmbedding(torch.nn.Module):
+    def __init__(self, config):
+        super().__init__()
+        self.rope_init_fn = ROPE_INIT_FUNCTIONS[self.rope_type]
+
+    def forward(self, x, position_ids):
+        # Core RoPE block
+        inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
+        return inv_freq_expanded
+
+
+class OpensciAttention(torch.nn.Module):
+    def forward(self, hidden_states, **kwargs: LossKwargs):
+        attention_interface: Callable = eager_attention_forward
+        if self.config._attn_implementation != "eager":
+            if self.config._attn_implementation == "sdpa" and kwargs.get("output_attentions", False):
+                logger.warning_once(
+                    "`torch.nn.functional.scaled_dot_product_attention` does not support `output_attentions=True`. Falling back to "
+                    'eager attention. This warning can be removed using the argument `attn_implementation="eager"` when loading the model.'
+                )
+            else:
+                attention_interface = ALL_ATTENTION_FUNCTIONS[self.config._attn_implementation]
+        return attention_interface
+
+
+class OpensciForCausalLM(torch.nn.Module):
+    _tied_weights_keys = ["lm_head.weight"]
+'''
+
+
+def test_patch_file_synthetic(tmp_path):
+    """All five fixes apply and the result is still valid Python."""
+    path = tmp_path / "modeling_opensci.py"
+    path.write_text(_SYNTHETIC_MODELING, encoding="utf-8")
+    assert patch_file(path)
+    out = path.read_text(encoding="utf-8")
+
+    tree = ast.parse(out)
+    funcs = [n.name for n in tree.body if isinstance(n, ast.FunctionDef)]
+    assert funcs.count("_sdpa_mha_forward") == 1
+    assert funcs.index("_sdpa_mha_forward") < funcs.index("eager_attention_forward")
+
+    # 1. LossKwargs → TransformersKwargs
+    assert "LossKwargs" not in out
+    assert "from transformers.utils import TransformersKwargs\n" in out
+    assert "**kwargs: TransformersKwargs" in out
+    # 2. ROPE 'default' fallback
+    assert (
+        "        if self.rope_type in ROPE_INIT_FUNCTIONS:\n"
+        "            self.rope_init_fn = ROPE_INIT_FUNCTIONS[self.rope_type]\n"
+        "        else:\n"
+    ) in out
+    assert "            self.rope_init_fn = _default_rope_init\n" in out
+    # 3. _tied_weights_keys list → dict
+    assert '_tied_weights_keys = {"lm_head.weight": "model.embed_tokens.weight"}\n' in out
+    # 4. SDPA dispatch routed to the module-level wrapper
+    assert "            attention_interface = _sdpa_mha_forward\n" in out
+    assert "enable_gqa" not in out.split("def _sdpa_mha_forward", 1)[1].split("\ndef ", 1)[0]
+    # 5. inv_freq re-init guard
+    assert "        if not self.inv_freq.any():\n" in out
+
+
+def test_patch_file_no_anchors(tmp_path):
+    """Files without any patch anchor are reported unpatched and left untouched."""
+    path = tmp_path / "modeling_other.py"
+    path.write_text("x = 1\n", encoding="utf-8")
+    assert not patch_file(path)
+    assert path.read_text(encoding="utf-8") == "x = 1\n"
+
+
+def test_patch_file_tied_keys_skip_empty(tmp_path):
+    """Empty quoted keys are dropped from the tied-weights dict, as before."""
+    path = tmp_path / "modeling_opensci.py"
+    path.write_text('_tied_weights_keys = ["lm_head.weight", ""]\n', encoding="utf-8")
+    assert patch_file(path)
+    assert path.read_text(encoding="utf-8") == (
+        '_tied_weights_keys = {"lm_head.weight": "model.embed_tokens.weight"}\n'
+    )
+
+
+def test_hotfix_links_weights_and_copies_modeling(tmp_path):
+    """Untouched files are hardlinked; modeling files are separate, patched copies."""
+    src = tmp_path / "model"
+    src.mkdir()
+    (src / "modeling_x.py").write_text(_SYNTHETIC_MODELING, encoding="utf-8")
+    (src / "model.safetensors").write_bytes(b"\0" * 1024)
+    (src / "config.json").write_text("{}", encoding="utf-8")
+
+    fixed = hotfix_opensci(src)
+
+    assert fixed == tmp_path / "model_fixed"
+    for name in ("model.safetensors", "config.json"):
+        assert (fixed / name).stat().st_nlink == 2
+        assert (fixed / name).stat().st_ino == (src / name).stat().st_ino
+    assert (fixed / "modeling_x.py").stat().st_ino != (src / "modeling_x.py").stat().st_ino
+    assert "_sdpa_mha_forward" in (fixed / "modeling_x.py").read_text(encoding="utf-8")
+    assert (src / "modeling_x.py").read_text(encoding="utf-8") == _SYNTHETIC_MODELING